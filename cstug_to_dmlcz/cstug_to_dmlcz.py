@@ -1,18 +1,28 @@
-from typing import Iterable, Tuple, Optional, Dict
-from itertools import chain
-import json
+from typing import Any, Iterable, List, Tuple, Optional, Dict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import io
 from pathlib import Path
-import subprocess
 import re
 
 import click
 from lxml import etree
-from PyPDF2 import PdfFileReader, PdfFileWriter
+from lxml.builder import E
+import pikepdf
 import pycountry
 import requests
 
 
 NAMESPACES = dict()
+XPATH_CACHE: Dict[str, etree.XPath] = dict()
+WHITESPACE = re.compile(r'\s+')
+MAX_DOI_WORKERS = 16
+SESSION = requests.Session()
+SESSION.headers.update({'Accept': 'application/vnd.citationstyles.csl+json'})
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=MAX_DOI_WORKERS,
+    pool_maxsize=MAX_DOI_WORKERS,
+))
 ELEMENT_REPLACEMENTS = {
     'CSTUG': 'CSTUG',
     'CSplain': 'CSplain',
@@ -33,6 +43,19 @@ ELEMENT_REPLACEMENTS = {
     'Thanh': 'Thành',
     'br': '\n',
 }
+DOI_OPTIONAL_ELEMENTS = (
+    (('publisher',), 'publisher'),
+    (('published-print', 'date-parts', 0, 0), 'year'),
+    (('issue',), 'number'),
+    (('volume',), 'volume'),
+    (('page',), 'pages'),
+    (('ISSN', 0), 'ISSN'),
+)
+INVERTED_LANGUAGES = {
+    'cze': 'eng',
+    'slo': 'eng',
+    'eng': 'TODO: cze nebo slo, který z nich to je?',
+}
 
 
 class JournalIssue:
@@ -40,41 +63,48 @@ class JournalIssue:
         self.input_pdf = input_pdf
         self.page_offset = page_offset
 
-        journal = read_xml(input_xml)
-
-        doi_base = journal.attrib['doi-base']
-        year = journal.attrib['year']
-        issue = journal.attrib['issue']
-        doi = '{}/{}-{}'.format(doi_base, year, issue)
-
-        articles = xpath(journal, 'article')
-        articles = [
-            JournalArticle(article, doi)
-            for article
-            in articles
-        ]
-        self.articles = articles
+        self.articles = []
+        doi = None
+        for event, element in parse_xml(input_xml):
+            if event == 'start' and element.getparent() is None:
+                if element.tag != 'bulletin':
+                    raise ValueError(f'Unexpected root element {element.tag}')
+                doi_base = element.attrib['doi-base']
+                year = element.attrib['year']
+                issue = element.attrib['issue']
+                doi = f'{doi_base}/{year}-{issue}'
+            elif event == 'end' and element.tag == 'article':
+                article = JournalArticle(element, doi)
+                self.articles.append(article)
+                element.clear(keep_tail=True)
         assert self.articles
 
     @property
     def first_page_number(self):
         return self.articles[0].pages[0]
 
-    def write_xml(self, output_dir: Path):
+    def write_xml(self, output_dir: Path, pretty_print: bool = False):
         output_dir.mkdir(exist_ok=True)
 
-        input_pdf = read_pdf(self.input_pdf)
-
-        for article_number, article in enumerate(self.articles):
-            article_number += 1
-            article_number = '#{}'.format(article_number)
-            article_directory = output_dir / article_number
-            article.write_xml(article_directory)
-            article.write_pdf(article_directory, input_pdf, self.page_offset, self.first_page_number)
+        article_jobs = [
+            (
+                article,
+                output_dir / f'#{article_number + 1}',
+                self.input_pdf,
+                self.page_offset,
+                self.first_page_number,
+                pretty_print,
+            )
+            for article_number, article
+            in enumerate(self.articles)
+        ]
+        with ProcessPoolExecutor() as executor:
+            for _ in executor.map(write_article, article_jobs):
+                pass
 
     def __repr__(self):
         return '\n'.join(
-            '#{}/ {}'.format(article_number+1, repr(article))
+            f'#{article_number + 1}/ {article!r}'
             for article_number, article
             in enumerate(self.articles)
         )
@@ -84,6 +114,7 @@ class JournalArticle:
     def __init__(self, journal_article: etree._Element, doi_base: str):
         language = journal_article.attrib['language']
         self.language = normalize_language(language)
+        self._other_language = invert_language(self.language)
         self._load_titles(journal_article)
         self._load_authors(journal_article)
         self._load_pages(journal_article)
@@ -93,127 +124,147 @@ class JournalArticle:
         self._load_summaries(journal_article)
         self._load_keywords(journal_article)
 
-    def write_xml(self, output_dir: Path):
-        self._write_meta_xml(output_dir)
+    def write_xml(self, output_dir: Path, pretty_print: bool = False):
+        output_dir.mkdir(exist_ok=True)
+        self._write_meta_xml(output_dir, pretty_print)
         if self.references:
-            self._write_references_xml(output_dir)
+            self._write_references_xml(output_dir, pretty_print)
 
-    def _write_meta_xml(self, output_dir: Path):
+    def _write_meta_xml(self, output_dir: Path, pretty_print: bool = False):
         article = etree.Element('article')
-        document = etree.ElementTree(article)
 
-        for title_language, title_text in self.titles:
-            title = etree.SubElement(article, 'title', lang=title_language)
-            title.text = title_text
+        article.extend(
+            E.title(title_text, lang=title_language)
+            for title_language, title_text
+            in self.titles
+        )
 
-        for author_order, last_name, first_name in self.authors:
-            author_order = str(author_order)
-            author = etree.SubElement(article, 'author', order=author_order)
-            author.text = '{}, {}'.format(last_name, first_name)
+        article.extend(
+            E.author(f'{last_name}, {first_name}', order=str(author_order))
+            for author_order, last_name, first_name
+            in self.authors
+        )
 
-        language = etree.SubElement(article, 'language')
-        language.text = self.language
+        article.append(E.language(self.language))
 
-        for keyword_language, keyword_text in self.keywords:
-            keyword = etree.SubElement(article, 'keyword', lang=keyword_language)
-            keyword.text = keyword_text
+        article.extend(
+            E.keyword(keyword_text, lang=keyword_language)
+            for keyword_language, keyword_text
+            in self.keywords
+        )
 
-        for summary_language, summary_text in self.summaries:
-            summary = etree.SubElement(article, 'summary', lang=summary_language)
-            summary.text = summary_text
+        article.extend(
+            E.summary(summary_text, lang=summary_language)
+            for summary_language, summary_text
+            in self.summaries
+        )
 
         if self.main_summary_language is not None:
-            etree.SubElement(article, 'lang_summary').text = self.main_summary_language
+            article.append(E.lang_summary(self.main_summary_language))
 
         if self.doi is not None:
-            doi = etree.SubElement(article, 'doi')
-            doi.text = self.doi
-
-        category = etree.SubElement(article, 'category')
-        category.text = self.category
+            article.append(E.doi(self.doi))
 
-        range_pages = etree.SubElement(article, 'range_pages')
-        range_pages.text = '{}-{}'.format(*self.pages)
+        article.append(E.category(self.category))
+        article.append(E.range_pages('{}-{}'.format(*self.pages)))
 
-        output_dir.mkdir(exist_ok=True)
-        write_xml(output_dir / 'meta.xml', document)
+        write_xml(output_dir / 'meta.xml', article, pretty_print)
 
-    def _write_references_xml(self, output_dir: Path):
+    def _write_references_xml(self, output_dir: Path, pretty_print: bool = False):
         references = etree.Element('references')
-        document = etree.ElementTree(references)
-
-        for refid, prefix, title, author_names, suffix, optionals in self.references:
-            reference = etree.SubElement(references, 'reference', id=str(refid))
-            etree.SubElement(reference, 'prefix').text = prefix
-            etree.SubElement(reference, 'title').text = title
-            authors = etree.SubElement(reference, 'authors')
-            for first_name, last_name in author_names:
-                author = '{}, {}'.format(last_name, first_name) if first_name else last_name
-                etree.SubElement(authors, 'author').text = author
-            for optional_element_name, optional_element_text in sorted(optionals.items()):
-                etree.SubElement(reference, optional_element_name).text = optional_element_text
-            etree.SubElement(reference, 'suffix').text = suffix
 
-        output_dir.mkdir(exist_ok=True)
-        write_xml(output_dir / 'references.xml', document)
+        references.extend(
+            E.reference(
+                E.prefix(prefix),
+                E.title(title),
+                E.authors(*(
+                    E.author(f'{last_name}, {first_name}' if first_name else last_name)
+                    for first_name, last_name
+                    in author_names
+                )),
+                *(
+                    E(optional_element_name, optional_element_text)
+                    for optional_element_name, optional_element_text
+                    in sorted(optionals.items())
+                ),
+                E.suffix(suffix),
+                id=str(refid),
+            )
+            for refid, prefix, title, author_names, suffix, optionals
+            in self.references
+        )
 
-    def write_pdf(self, output_dir: Path, input_pdf: PdfFileReader, page_offset: int, first_page_number: int):
-        output_pdf = PdfFileWriter()
+        write_xml(output_dir / 'references.xml', references, pretty_print)
+
+    def write_pdf(self, output_dir: Path, input_pages: List, page_offset: int, first_page_number: int):
+        output_pdf = pikepdf.Pdf.new()
 
         first_page, last_page = self.pages
-        for page_number in range(first_page, last_page + 1):
-            page_number += page_offset
-            page_number -= first_page_number
-            page = input_pdf.getPage(page_number)
-            output_pdf.addPage(page)
+        first_page += page_offset - first_page_number
+        last_page += page_offset - first_page_number
+        if first_page < 0 or last_page >= len(input_pages):
+            message = f'Pages {first_page}-{last_page} fall outside the input PDF with {len(input_pages)} pages'
+            raise IndexError(message)
+        output_pdf.pages.extend(input_pages[first_page:last_page + 1])
 
-        output_dir.mkdir(exist_ok=True)
         write_pdf(output_dir / 'source.pdf', output_pdf)
 
     def _load_titles(self, journal_article: etree._Element):
-        self.titles = set()
+        self.titles = []
+
+        titles, = xpath(journal_article, 'titles')
+
+        title_text = None
+        subtitle_text = None
+        original_title_text = None
+        original_title_language = None
+        original_subtitle_text = None
+        previous_tag = None
+        for element in titles.iterchildren():
+            if element.tag == 'title':
+                assert title_text is None
+                title_text = get_text(element)
+            elif element.tag == 'original_language_title':
+                assert original_title_text is None
+                original_title_text = get_text(element)
+                original_title_language = normalize_language(element.attrib['language'])
+            elif element.tag == 'subtitle':
+                if previous_tag == 'title' and subtitle_text is None:
+                    subtitle_text = get_text(element)
+                elif previous_tag == 'original_language_title' and original_subtitle_text is None:
+                    original_subtitle_text = get_text(element)
+            previous_tag = element.tag
 
         # Main title
-        title, = xpath(journal_article, 'titles/title')
-        title_text = get_text(title)
+        assert title_text is not None
+        if subtitle_text is not None:
+            title_text = f'{title_text}: {subtitle_text}'
         title_language = self.language
 
-        subtitles = xpath(journal_article, 'titles/subtitle')
-        for subtitle in subtitles:
-            if subtitle.getprevious().tag != 'title':
-                continue
-            subtitle_text = get_text(subtitle)
-            title_text = '{}: {}'.format(title_text, subtitle_text)
-            break
-
-        self.titles.add((title_language, title_text))
+        title = (title_language, title_text)
+        if title not in self.titles:
+            self.titles.append(title)
 
         # Original language title
-        original_titles = xpath(journal_article, 'titles/original_language_title')
-        if original_titles:
-            original_title, = original_titles
-            original_title_text = get_text(original_title)
-            original_title_language = normalize_language(original_title.attrib['language'])
-
-            original_subtitles = xpath(journal_article, 'titles/subtitle')
-            for original_subtitle in original_subtitles:
-                if original_subtitle.getprevious().tag != 'original_language_title':
-                    continue
-                original_subtitle_text = get_text(original_subtitle)
-                original_title_text = '{}: {}'.format(original_title_text, original_subtitle_text)
-                break
-
-            self.titles.add((original_title_language, original_title_text))
+        if original_title_text is not None:
+            if original_subtitle_text is not None:
+                original_title_text = f'{original_title_text}: {original_subtitle_text}'
+
+            original_title = (original_title_language, original_title_text)
+            if original_title not in self.titles:
+                self.titles.append(original_title)
 
         # Additional content title
         additional_titles = xpath(journal_article, 'additional-content/title')
         if additional_titles:
             additional_title, = additional_titles
             additional_title_text = get_text(additional_title)
-            additional_title_language = invert_language(title_language)
-            self.titles.add((additional_title_language, additional_title_text))
+            additional_title_language = self._other_language
+            additional_title = (additional_title_language, additional_title_text)
+            if additional_title not in self.titles:
+                self.titles.append(additional_title)
 
-        self.titles = sorted(self.titles)
+        self.titles.sort()
 
     def _load_authors(self, journal_article: etree._Element):
         self.authors = []
@@ -229,12 +280,13 @@ class JournalArticle:
         last_page, = xpath(journal_article, 'pages/last_page')
         last_page = int(get_text(last_page))
         if first_page > last_page:
-            raise ValueError('First page ({}) greater than last page ({})'.format(first_page, last_page))
+            raise ValueError(f'First page ({first_page}) greater than last page ({last_page})')
         self.pages = (first_page, last_page)
 
     def _load_doi(self, journal_article: etree._Element, doi_base: str):
         if 'doi' in journal_article.attrib:
-            self.doi = '{}/{}'.format(doi_base, journal_article.attrib['doi'])
+            doi = journal_article.attrib['doi']
+            self.doi = f'{doi_base}/{doi}'
         else:
             self.doi = None
 
@@ -244,9 +296,19 @@ class JournalArticle:
     def _load_references(self, journal_article: etree._Element):
         self.references = list()
         references = xpath(journal_article, 'citation_list/citation')
+
+        dois = [
+            get_text(doi)
+            for reference
+            in references
+            for doi
+            in xpath(reference, 'doi')
+        ]
+        resolve_dois(dois)
+
         for refid, reference in enumerate(references):
             refid += 1
-            prefix = '[{}]'.format(refid)
+            prefix = f'[{refid}]'
             dois = xpath(reference, 'doi')
             article_titles = xpath(reference, 'article_title')
             unstructured_citations = xpath(reference, 'unstructured_citation')
@@ -256,7 +318,7 @@ class JournalArticle:
                 doi, = dois
                 doi = get_text(doi)
                 title = 'TODO: Doplnit!'
-                optionals['URL'] = 'https://dx.doi.org/{}'.format(doi)
+                optionals['URL'] = f'https://dx.doi.org/{doi}'
                 suffix = 'TODO: Doplnit!'
 
                 resolved_doi = resolve_doi(doi)
@@ -274,28 +336,10 @@ class JournalArticle:
                         author_names.append((None, name))
                     else:
                         assert False, resolved_doi['author'][0]
-
-
-                def find_optional_in_json(input_address: Iterable[str], output_element_name: str) -> None:
-                    element = resolved_doi
-                    for fragment in input_address:
-                        if not isinstance(element, (dict, list)):
-                            break
-                        if isinstance(element, dict) and fragment not in element:
-                            break
-                        if isinstance(element, list) and fragment >= len(element):
-                            break
-                        element = element[fragment]
-                    if isinstance(element, (dict, list)):
-                        return
-                    optionals[output_element_name] = str(element)
-
-                find_optional_in_json(['publisher'], 'publisher')
-                find_optional_in_json(['published-print', 'date-parts', 0, 0], 'year')
-                find_optional_in_json(['issue'], 'number')
-                find_optional_in_json(['volume'], 'volume')
-                find_optional_in_json(['page'], 'pages')
-                find_optional_in_json(['ISSN', 0], 'ISSN')
+                for input_address, output_element_name in DOI_OPTIONAL_ELEMENTS:
+                    optional_element = find_in_json(resolved_doi, input_address)
+                    if optional_element is not None:
+                        optionals[output_element_name] = str(optional_element)
 
             elif article_titles:
                 title, = article_titles
@@ -305,7 +349,7 @@ class JournalArticle:
                 suffix = 'TODO: Doplnit!'
 
                 def find_optional_in_xml(input_element_name: str, output_element_name: str) -> None:
-                    elements = xpath(reference, './/{}'.format(input_element_name))
+                    elements = xpath(reference, f'.//{input_element_name}')
                     if elements:
                         element, *_ = elements
                         optionals[output_element_name] = get_text(element)
@@ -332,8 +376,7 @@ class JournalArticle:
     def _load_keywords(self, journal_article: etree._Element):
         self.keywords = []
 
-        abstracts = xpath(journal_article, 'additional-content/abstract')
-        for abstract in abstracts:
+        for abstract, is_main_abstract in get_abstracts(journal_article):
 
             keywords = xpath(abstract, 'keywords')
             if not keywords:
@@ -341,50 +384,69 @@ class JournalArticle:
             keywords, = keywords
             keywords = get_text(keywords)
 
-            keyword_texts = re.split(', *', keywords)
+            keyword_texts = [
+                keyword_text.strip()
+                for keyword_text
+                in keywords.split(',')
+                if keyword_text.strip()
+            ]
             if not keyword_texts:
                 continue
 
-            if abstract.getprevious() is None:
+            if is_main_abstract:
                 keyword_language = self.language
             else:
-                keyword_language = invert_language(self.language)
+                keyword_language = self._other_language
 
             for keyword_text in keyword_texts:
                 keyword = (keyword_language, keyword_text)
                 self.keywords.append(keyword)
 
     def _load_summaries(self, journal_article: etree._Element):
-        self.summaries = set()
+        self.summaries = []
         self.main_summary_language = None
 
-        abstracts = xpath(journal_article, 'additional-content/abstract')
-        for abstract in abstracts:
+        for abstract, is_main_abstract in get_abstracts(journal_article):
 
             paragraphs = xpath(abstract, 'para')
             if not paragraphs:
                 continue
 
-            if abstract.getprevious() is None:
+            if is_main_abstract:
                 summary_language = self.language
                 self.main_summary_language = summary_language
             else:
-                summary_language = invert_language(self.language)
+                summary_language = self._other_language
 
-            summary_text = '\n\n'.join(map(get_text, paragraphs))
+            summary_buffer = io.StringIO()
+            for paragraph in paragraphs:
+                summary_buffer.write(get_text(paragraph))
+                summary_buffer.write('\n\n')
+            summary_text = summary_buffer.getvalue().rstrip()
             summary = (summary_language, summary_text)
-            self.summaries.add(summary)
+            if summary not in self.summaries:
+                self.summaries.append(summary)
 
-        self.summaries = sorted(self.summaries)
+        self.summaries.sort()
 
     def __repr__(self):
         (_, author, __), *other_authors = self.authors
         if other_authors:
-            author = '{} et al.'.format(author)
+            author = f'{author} et al.'
         (_, title), *__ = self.titles
         return '{}. {}. {}-{}'.format(author, title, *self.pages)
 
 
+def write_article(article_job: Tuple['JournalArticle', Path, Path, int, int, bool]) -> None:
+    article, article_directory, input_pdf, page_offset, first_page_number, pretty_print = article_job
+    article_directory.mkdir(exist_ok=True)
+    article.write_xml(article_directory, pretty_print)
+    with read_pdf(input_pdf) as source_pdf:
+        input_pages = list(source_pdf.pages)
+        article.write_pdf(article_directory, input_pages, page_offset, first_page_number)
+
+
+@lru_cache(maxsize=None)
 def normalize_language(language_code: str) -> str:
     language = pycountry.languages.get(alpha_2=language_code)
     try:
@@ -396,38 +458,16 @@ def normalize_language(language_code: str) -> str:
 
 
 def invert_language(language_code: str) -> str:
-    assert language_code in ('cze', 'slo', 'eng')
-    if language_code in ('cze', 'slo'):
-        inverted_language = 'eng'
-    else:
-        inverted_language = 'TODO: cze nebo slo, který z nich to je?'
-    return inverted_language
-
-
-def replace_elements_with_text(element: etree._Element, element_name: str, replacement_text: str) -> None:
-    for subelement in element.xpath('//{}'.format(element_name)):
-        text = '{}{}'.format(replacement_text, subelement.tail or '')
-        parent = subelement.getparent()
-        if parent is not None:
-            previous = subelement.getprevious()
-            if previous is not None:
-                previous.tail = '{}{}'.format(previous.tail or '', text)
-            else:
-                parent.text = '{}{}'.format(parent.text or '', text)
-            parent.remove(subelement)
+    return INVERTED_LANGUAGES[language_code]
 
 
 def get_author_names(element: etree._Element) -> Iterable[Tuple[Optional[str], str]]:
-    authors = chain(
-        xpath(
-            element,
-            'contributors/person_name[@sequence = "first" and @contributor_role = "author"]',
-        ),
-        xpath(
-            element,
-            'contributors/person_name[@sequence = "additional" and @contributor_role = "author"]',
-        ),
+    authors = xpath(
+        element,
+        'contributors/person_name[@contributor_role = "author" and '
+        '(@sequence = "first" or @sequence = "additional")]',
     )
+    authors.sort(key=lambda author: 0 if author.attrib['sequence'] == 'first' else 1)
     for author in authors:
         first_names = xpath(author, 'given_name')
         if first_names:
@@ -441,56 +481,93 @@ def get_author_names(element: etree._Element) -> Iterable[Tuple[Optional[str], s
         yield (first_name, last_name)
 
 
+def find_in_json(element: Any, input_address: Iterable) -> Optional[Any]:
+    for fragment in input_address:
+        if not isinstance(element, (dict, list)):
+            break
+        if isinstance(element, dict) and fragment not in element:
+            break
+        if isinstance(element, list) and fragment >= len(element):
+            break
+        element = element[fragment]
+    if isinstance(element, (dict, list)):
+        return None
+    return element
+
+
+def get_abstracts(journal_article: etree._Element) -> Iterable[Tuple[etree._Element, bool]]:
+    for additional_content in xpath(journal_article, 'additional-content'):
+        for element_number, element in enumerate(additional_content.iterchildren()):
+            if element.tag == 'abstract':
+                yield (element, element_number == 0)
+
+
 def get_text(element: etree._Element) -> str:
-    element = etree.fromstring(etree.tostring(element))
-    for replacement_element_name, replacement_text in ELEMENT_REPLACEMENTS.items():
-        replace_elements_with_text(element, replacement_element_name, replacement_text)
-    texts = xpath(element, './/text()')
-    texts = map(str.strip, texts)
-    texts = filter(lambda x: x, texts)
-    texts = ' '.join(texts).split()
-    return ' '.join(texts)
+    texts = []
+    extract_texts(element, texts)
+    text = ' '.join(texts)
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def extract_texts(element: etree._Element, texts: List[str]) -> None:
+    text = [element.text or '']
+    for subelement in element:
+        if subelement.tag in ELEMENT_REPLACEMENTS:
+            text.append(ELEMENT_REPLACEMENTS[subelement.tag])
+            text.append(subelement.tail or '')
+        else:
+            texts.append(''.join(text))
+            if isinstance(subelement.tag, str):
+                extract_texts(subelement, texts)
+            text = [subelement.tail or '']
+    texts.append(''.join(text))
+
 
+def resolve_dois(dois: List[str]) -> None:
+    if not dois:
+        return
+    max_workers = min(MAX_DOI_WORKERS, len(dois))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(resolve_doi, dois):
+            pass
 
+
+@lru_cache(maxsize=None)
 def resolve_doi(doi: str) -> Dict:
-    url = 'https://dx.doi.org/{}'.format(doi)
-    headers = {'Accept': 'application/vnd.citationstyles.csl+json'}
-    result = requests.get(url, headers=headers)
+    url = f'https://dx.doi.org/{doi}'
+    result = SESSION.get(url, timeout=30)
     if result.status_code == 200:
-        return json.loads(result.text)
+        return result.json()
     else:
         return dict()
 
 
-def xpath(element: etree._Element, expression: str) -> Iterable[etree._Element]:
-    return element.xpath(expression, namespaces=NAMESPACES)
+def xpath(element: etree._Element, expression: str) -> List[etree._Element]:
+    if expression not in XPATH_CACHE:
+        XPATH_CACHE[expression] = etree.XPath(expression, namespaces=NAMESPACES or None)
+    compiled_expression = XPATH_CACHE[expression]
+    return compiled_expression(element)
 
 
-def read_xml(filename: Path) -> etree._Element:
-    process = subprocess.Popen(
-        ['xmllint', '--xinclude', str(filename)],
-        stdout=subprocess.PIPE,
-    )
-    stdout, *_ = process.communicate()
-    root = etree.fromstring(stdout)
-    if root.tag != 'bulletin':
-        raise ValueError('Unexpected root element {}'.format(root.tag))
-    return root
+def parse_xml(filename: Path) -> Iterable[Tuple[str, etree._Element]]:
+    tree = etree.parse(str(filename))
+    tree.xinclude()
+    yield from etree.iterwalk(tree.getroot(), events=('start', 'end'))
 
 
-def write_xml(filename: Path, tree: etree.ElementTree):
-    with filename.open('wb') as f:
-        tree.write(f, xml_declaration=True, encoding='utf-8', pretty_print=True)
+def write_xml(filename: Path, root: etree._Element, pretty_print: bool = False):
+    document = etree.tostring(root, xml_declaration=True, encoding='utf-8', pretty_print=pretty_print)
+    filename.write_bytes(document)
 
 
-def read_pdf(filename: Path) -> PdfFileReader:
-    reader = PdfFileReader(str(filename), strict=False)
+def read_pdf(filename: Path) -> pikepdf.Pdf:
+    reader = pikepdf.Pdf.open(str(filename))
     return reader
 
 
-def write_pdf(filename: Path, pdf: PdfFileWriter):
-    with filename.open('wb') as f:
-        pdf.write(f)
+def write_pdf(filename: Path, pdf: pikepdf.Pdf):
+    with filename.open('wb', buffering=1 << 20) as f:
+        pdf.save(f)
 
 
 @click.command()
@@ -498,9 +575,10 @@ def write_pdf(filename: Path, pdf: PdfFileWriter):
 @click.option('--input-pdf', help='The input PDF with an issue.', type=click.Path(exists=True))
 @click.option('--page-offset', default=2, help='The offset between PDF\'s first physical and logical pages')
 @click.option('--output-dir', help='The output DML-CZ directory with an issue.', type=click.Path(dir_okay=True))
-def main(input_xml: str, input_pdf: str, page_offset: int, output_dir: str):
+@click.option('--pretty', is_flag=True, help='Pretty-print the output XML.')
+def main(input_xml: str, input_pdf: str, page_offset: int, output_dir: str, pretty: bool):
     issue = JournalIssue(Path(input_xml), Path(input_pdf), page_offset)
-    issue.write_xml(Path(output_dir))
+    issue.write_xml(Path(output_dir), pretty)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,20 @@
 # -*- coding:utf-8 -*-
 
+import sys
+
 from setuptools import setup
 
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+
+if cythonize is not None and sys.implementation.name == 'cpython':
+    ext_modules = cythonize('cstug_to_dmlcz/cstug_to_dmlcz.py', language_level=3)
+else:
+    ext_modules = []
+
 
 setup(
     name='cstug-to-dmlcz',
@@ -12,18 +25,20 @@ setup(
     description='Converts CSTUG XML to DML-CZ XML',
     packages=['cstug_to_dmlcz'],
     package_dir={'cstug_to_dmlcz': 'cstug_to_dmlcz'},
+    ext_modules=ext_modules,
     entry_points={
         'console_scripts': [
             'cstug-to-dmlcz=cstug_to_dmlcz.cstug_to_dmlcz:main',
         ],
     },
+    python_requires='>=3.7',
     setup_requires=[
         'setuptools',
     ],
     install_requires=[
         'lxml~=4.6.2',
         'click~=7.1.2',
-        'PyPDF2~=1.26.0',
+        'pikepdf~=5.1',
         'pycountry~=20.7.3',
         'requests~=2.26.0',
     ],